@@ -1,24 +1,44 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-import sys, re, argparse
-import fcntl
+import sys, argparse
 import os
-import locale
 import time
-import datetime
-import ephem
+import struct
 import pigpio
-import socket
-import signal, atexit, traceback
-import logging, logging.handlers
+import logging
 import threading
+import queue
+import contextlib
+import gc
 
 import paho.mqtt.client as mqtt
 import json
 
+log = logging.getLogger(__name__)
+
+# Run the block with SCHED_FIFO priority and the garbage collector paused, to keep scheduler preemption and GC
+# pauses away from the wave submission. Keep the block short, GC is off for the whole process meanwhile. Silently runs at normal priority without CAP_SYS_NICE.
+@contextlib.contextmanager
+def realtime():
+    elevated = False
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(os.sched_get_priority_max(os.SCHED_FIFO) - 5))
+        elevated = True
+    except (AttributeError, OSError):
+        pass
+    gcEnabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gcEnabled:
+            gc.enable()
+        if elevated:
+            os.sched_setscheduler(0, os.SCHED_OTHER, os.sched_param(0))
+
 class Config:
-    def __init__(self):
+    def __init__(self, codeFile = None):
         self.TXGPIO = 16
         self.Shutters = {
             "1": {'name': 'Rolluik1', 'durationDown': 20, 'durationUp': 20, 'intermediatePosition': 50, 'code': 1},
@@ -26,8 +46,76 @@ class Config:
         }
         self.SendRepeat = 2
 
+        # The shutter id doubles as the hex remote address, parse it once instead of on every command
+        for shutterId, shutter in self.Shutters.items():
+            shutter['teleco'] = int(shutterId, 16)
+            shutter['code'] = int(shutter['code'])
+
+        # Rolling codes are persisted to codeFile (if given) by a single writer thread, off the transmit path
+        self.codeLock = threading.Lock()
+        self.writeLock = threading.Lock()
+        self.codeFile = codeFile
+        self.persistQueue = None
+        if codeFile != None:
+            self.loadCodes()
+            self.persistQueue = queue.Queue()
+            threading.Thread(target = self.persistWorker, daemon = True).start()
+
     def setCode(self, shutterId, new_code):
-        self.Shutters[shutterId]['code'] = new_code
+        with self.codeLock:
+            self.Shutters[shutterId]['code'] = int(new_code)
+        self.persistCodes()
+
+    # Hand out the current rolling code and advance it in one atomic step
+    def nextCode(self, shutterId):
+        with self.codeLock:
+            code = self.Shutters[shutterId]['code']
+            self.Shutters[shutterId]['code'] = code + 1
+        self.persistCodes()
+        return code
+
+    def persistCodes(self):
+        if self.persistQueue != None:
+            self.persistQueue.put(None)
+
+    def loadCodes(self):
+        if not os.path.exists(self.codeFile): # first run, start from the configured codes
+            return
+        try:
+            with open(self.codeFile) as f:
+                codes = json.load(f)
+            if not isinstance(codes, dict):
+                raise ValueError("expected an object of shutter id to code")
+            loaded = {shutterId: int(code) for shutterId, code in codes.items() if shutterId in self.Shutters}
+        except (OSError, ValueError, TypeError) as e:
+            log.warning("Could not load rolling codes from %s: %s", self.codeFile, e)
+            return
+        for shutterId, code in loaded.items():
+            self.Shutters[shutterId]['code'] = code
+
+    def persistWorker(self):
+        while True:
+            self.persistQueue.get()
+            while not self.persistQueue.empty(): # one write covers every update queued meanwhile
+                self.persistQueue.get_nowait()
+            self.writeCodes()
+
+    # Write the current codes synchronously, call it on shutdown so the last issued code is not lost
+    def flush(self):
+        if self.codeFile != None:
+            self.writeCodes()
+
+    def writeCodes(self):
+        with self.writeLock: # the writer thread and flush share the temp file
+            with self.codeLock:
+                codes = {shutterId: shutter['code'] for shutterId, shutter in self.Shutters.items()}
+            try:
+                tmpFile = self.codeFile + ".tmp"
+                with open(tmpFile, "w") as f:
+                    json.dump(codes, f)
+                os.replace(tmpFile, self.codeFile)
+            except OSError as e:
+                log.error("Could not persist rolling codes to %s: %s", self.codeFile, e)
 
 class Shutter:
     #Button values
@@ -40,6 +128,7 @@ class Shutter:
         position = None
         lastCommandTime = None
         lastCommandDirection = None
+        finalPositionTimer = None
 
         def __init__(self, initPosition = None):
             self.position = initPosition
@@ -48,10 +137,20 @@ class Shutter:
         def registerCommand(self, commandDirection):
             self.lastCommandDirection = commandDirection
             self.lastCommandTime = time.monotonic()
+            self.cancelFinalPosition()
+
+        # A new command makes the pending final position stale, wake its timer up now instead of at expiry.
+        # Call with Shutter.sutterStateLock held.
+        def cancelFinalPosition(self):
+            timer = self.finalPositionTimer
+            self.finalPositionTimer = None
+            if timer != None:
+                timer.cancel()
 
     def __init__(self, config = None):
         super(Shutter, self).__init__()
         self.lock = threading.Lock()
+        self.txLock = threading.Lock()
         
         if config != None:
             self.config = config
@@ -61,15 +160,41 @@ class Shutter:
         else:
            self.TXGPIO=16 # 433.42 MHz emitter on GPIO 16
         self.frame = bytearray(7)
+
+        # The pulses never change once TXGPIO is known, build them once and share them between all frames
+        mask = 1<<self.TXGPIO
+        self.bitHigh = pigpio.pulse(mask, 0, 640)
+        self.bitLow = pigpio.pulse(0, mask, 640)
+        self.wakeUp = [pigpio.pulse(mask, 0, 9415), pigpio.pulse(0, mask, 89565)] # wake up pulse & silence
+        self.hwSync = [pigpio.pulse(mask, 0, 2560), pigpio.pulse(0, mask, 2560)] # hardware synchronization
+        self.swSync = [pigpio.pulse(mask, 0, 4550), self.bitLow] # software synchronization
+        self.gap = pigpio.pulse(0, mask, 30415) # interframe gap
+
+        # Manchester encoding of every possible byte value, most significant bit first
+        bitSymbols = ((self.bitHigh, self.bitLow), (self.bitLow, self.bitHigh)) # symbol for a 0 and a 1 bit
+        self.bytePulses = []
+        for octet in range(256):
+            pulses = []
+            for shift in (7, 6, 5, 4, 3, 2, 1, 0):
+                pulses += bitSymbols[(octet >> shift) & 1]
+            self.bytePulses.append(tuple(pulses))
+
         self.callback = []
         self.shutterStateList = {}
-        self.sutterStateLock = threading.Lock()
+        self.sutterStateLock = threading.RLock()
+        self.pi = None # pigpiod connection, opened on first use and kept for the lifetime of the process
 
     def getShutterState(self, shutterId, initialPosition = None):
+        state = self.shutterStateList.get(shutterId)
+        if state == None:
+            # setdefault keeps whichever state got inserted first if two threads race here
+            state = self.shutterStateList.setdefault(shutterId, self.ShutterState(initialPosition))
+        return state
+
+    # finalPositionTimer is guarded by sutterStateLock, so commands are registered through here
+    def registerCommand(self, state, commandDirection):
         with self.sutterStateLock:
-            if shutterId not in self.shutterStateList:
-                self.shutterStateList[shutterId] = self.ShutterState(initialPosition)
-            return self.shutterStateList[shutterId]
+            state.registerCommand(commandDirection)
 
     def getPosition(self, shutterId):
         state = self.getShutterState(shutterId, 0)
@@ -79,43 +204,56 @@ class Shutter:
         state = self.getShutterState(shutterId)
         with self.sutterStateLock:
             state.position = newPosition
-        for function in self.callback:
+            callbacks = tuple(self.callback)
+        for function in callbacks:
             function(shutterId, newPosition)
 
+    # Schedule the final position on a timer instead of a sleeping thread. The next registerCommand (or a
+    # newer timer) for the same shutter cancels it right away.
     def waitAndSetFinalPosition(self, shutterId, timeToWait, newPosition):
         state = self.getShutterState(shutterId)
         oldLastCommandTime = state.lastCommandTime
 
-        print("["+self.config.Shutters[shutterId]['name']+"] Waiting for operation to complete for " + str(timeToWait) + " seconds")
-        time.sleep(timeToWait)
+        log.info("[%s] Waiting for operation to complete for %s seconds", self.config.Shutters[shutterId]['name'], timeToWait)
+        t = threading.Timer(timeToWait, self.setFinalPosition, args = (shutterId, oldLastCommandTime, newPosition))
+        t.daemon = True
+        with self.sutterStateLock:
+            state.cancelFinalPosition()
+            state.finalPositionTimer = t
+        t.start()
+
+    def setFinalPosition(self, shutterId, oldLastCommandTime, newPosition):
+        state = self.getShutterState(shutterId)
+        with self.sutterStateLock:
+            if state.finalPositionTimer is threading.current_thread():
+                state.finalPositionTimer = None
 
         # Only set new position if registerCommand has not been called in between
         if state.lastCommandTime == oldLastCommandTime:
-            print("["+self.config.Shutters[shutterId]['name']+"] Set new final position: " + str(newPosition))
+            log.info("[%s] Set new final position: %s", self.config.Shutters[shutterId]['name'], newPosition)
             self.setPosition(shutterId, newPosition)
         else:
-            print("["+self.config.Shutters[shutterId]['name']+"] Discard final position. Position is now: " + str(state.position))
+            log.info("[%s] Discard final position. Position is now: %s", self.config.Shutters[shutterId]['name'], state.position)
 
     def lower(self, shutterId):
         state = self.getShutterState(shutterId, 100)
 
-        print("["+self.config.Shutters[shutterId]['name']+"] Going down")
+        log.info("[%s] Going down", self.config.Shutters[shutterId]['name'])
         self.sendCommand(shutterId, self.buttonDown, self.config.SendRepeat)
-        state.registerCommand('down')
+        self.registerCommand(state, 'down')
 
         # wait and set final position only if not interrupted in between
         timeToWait = state.position/100*self.config.Shutters[shutterId]['durationDown']
-        t = threading.Thread(target = self.waitAndSetFinalPosition, args = (shutterId, timeToWait, 0))
-        t.start()
+        self.waitAndSetFinalPosition(shutterId, timeToWait, 0)
 
     def lowerPartial(self, shutterId, percentage):
         state = self.getShutterState(shutterId, 100)
 
-        print("["+self.config.Shutters[shutterId]['name']+"] Going down") 
+        log.info("[%s] Going down", self.config.Shutters[shutterId]['name'])
         self.sendCommand(shutterId, self.buttonDown, self.config.SendRepeat)
-        state.registerCommand('down')
+        self.registerCommand(state, 'down')
         time.sleep((state.position-percentage)/100*self.config.Shutters[shutterId]['durationDown'])
-        print("["+self.config.Shutters[shutterId]['name']+"] Stop at partial position requested")
+        log.info("[%s] Stop at partial position requested", self.config.Shutters[shutterId]['name'])
         self.sendCommand(shutterId, self.buttonStop, self.config.SendRepeat)
 
         self.setPosition(shutterId, percentage)
@@ -123,23 +261,22 @@ class Shutter:
     def rise(self, shutterId):
         state = self.getShutterState(shutterId, 0)
 
-        print("["+self.config.Shutters[shutterId]['name']+"] Going up")
+        log.info("[%s] Going up", self.config.Shutters[shutterId]['name'])
         self.sendCommand(shutterId, self.buttonUp, self.config.SendRepeat)
-        state.registerCommand('up')
+        self.registerCommand(state, 'up')
 
         # wait and set final position only if not interrupted in between
         timeToWait = (100-state.position)/100*self.config.Shutters[shutterId]['durationUp']
-        t = threading.Thread(target = self.waitAndSetFinalPosition, args = (shutterId, timeToWait, 100))
-        t.start()
+        self.waitAndSetFinalPosition(shutterId, timeToWait, 100)
 
     def risePartial(self, shutterId, percentage):
         state = self.getShutterState(shutterId, 0)
 
-        print("["+self.config.Shutters[shutterId]['name']+"] Going up")
+        log.info("[%s] Going up", self.config.Shutters[shutterId]['name'])
         self.sendCommand(shutterId, self.buttonUp, self.config.SendRepeat)
-        state.registerCommand('up')
+        self.registerCommand(state, 'up')
         time.sleep((percentage-state.position)/100*self.config.Shutters[shutterId]['durationUp'])
-        print("["+self.config.Shutters[shutterId]['name']+"] Stop at partial position requested")
+        log.info("[%s] Stop at partial position requested", self.config.Shutters[shutterId]['name'])
         self.sendCommand(shutterId, self.buttonStop, self.config.SendRepeat)
 
         self.setPosition(shutterId, percentage)
@@ -147,12 +284,12 @@ class Shutter:
     def stop(self, shutterId):
         state = self.getShutterState(shutterId, 50)
 
-        print("["+self.config.Shutters[shutterId]['name']+"] Stopping")
+        log.info("[%s] Stopping", self.config.Shutters[shutterId]['name'])
         self.sendCommand(shutterId, self.buttonStop, self.config.SendRepeat)
 
-        print("["+shutterId+"] Previous position: " + str(state.position))
+        log.debug("[%s] Previous position: %s", shutterId, state.position)
         secondsSinceLastCommand = int(round(time.monotonic() - state.lastCommandTime))
-        print("["+shutterId+"] Seconds since last command: " + str(secondsSinceLastCommand))
+        log.debug("[%s] Seconds since last command: %s", shutterId, secondsSinceLastCommand)
 
         # Compute position based on time elapsed since last command & command direction
         setupDurationDown = self.config.Shutters[shutterId]['durationDown']
@@ -162,52 +299,51 @@ class Shutter:
         if state.lastCommandDirection == 'up':
           if secondsSinceLastCommand > 0 and secondsSinceLastCommand < setupDurationUp:
             durationPercentage = int(round(secondsSinceLastCommand/setupDurationUp * 100))
-            print("["+shutterId+"] Up duration percentage: " + str(durationPercentage) + ", State position: "+ str(state.position))
+            log.debug("[%s] Up duration percentage: %s, State position: %s", shutterId, durationPercentage, state.position)
             if state.position > 0: # after rise from previous position
                 newPosition = min (100 , state.position + durationPercentage)
             else: # after rise from fully closed
                 newPosition = durationPercentage
           else:  #fallback
-            print("["+shutterId+"] Too much time since up command.")
+            log.debug("[%s] Too much time since up command.", shutterId)
             fallback = True
         elif state.lastCommandDirection == 'down':
           if secondsSinceLastCommand > 0 and secondsSinceLastCommand < setupDurationDown:
             durationPercentage = int(round(secondsSinceLastCommand/setupDurationDown * 100))
-            print("["+shutterId+"] Down duration percentage: " + str(durationPercentage) + ", State position: "+ str(state.position))
+            log.debug("[%s] Down duration percentage: %s, State position: %s", shutterId, durationPercentage, state.position)
             if state.position < 100: # after lower from previous position
                 newPosition = max (0 , state.position - durationPercentage)
             else: # after down from fully opened
                 newPosition = 100 - durationPercentage
           else:  #fallback
-            print("["+shutterId+"] Too much time since down command.")
+            log.debug("[%s] Too much time since down command.", shutterId)
             fallback = True
         else: # consecutive stops
-            print("["+shutterId+"] Stop pressed while stationary.")
+            log.debug("[%s] Stop pressed while stationary.", shutterId)
             fallback = True
 
         if fallback == True: # Let's assume it will end on the intermediate position ! If it exists !
             intermediatePosition = self.config.Shutters[shutterId]['intermediatePosition']
             if (intermediatePosition == None) or (intermediatePosition == state.position):
-                print("["+shutterId+"] Stay stationary.")
+                log.debug("[%s] Stay stationary.", shutterId)
                 newPosition = state.position
             else:
-                print("["+shutterId+"] Motor expected to move to intermediate position "+str(intermediatePosition))
+                log.info("[%s] Motor expected to move to intermediate position %s", shutterId, intermediatePosition)
                 if state.position > intermediatePosition:
-                    state.registerCommand('down')
+                    self.registerCommand(state, 'down')
                     timeToWait = abs(state.position - intermediatePosition) / 100*self.config.Shutters[shutterId]['durationDown']
                 else:
-                    state.registerCommand('up')
+                    self.registerCommand(state, 'up')
                     timeToWait = abs(state.position - intermediatePosition) / 100*self.config.Shutters[shutterId]['durationUp']
                 # wait and set final intermediate position only if not interrupted in between
-                t = threading.Thread(target = self.waitAndSetFinalPosition, args = (shutterId, timeToWait, intermediatePosition))
-                t.start()
+                self.waitAndSetFinalPosition(shutterId, timeToWait, intermediatePosition)
                 return
 
         # Save computed position
         self.setPosition(shutterId, newPosition)
 
         # Register command at the end to not impact the lastCommand timer
-        state.registerCommand(None)
+        self.registerCommand(state, None)
 
     # Push a set of buttons for a short or long press.
     def pressButtons(self, shutterId, buttons, longPress):
@@ -217,7 +353,40 @@ class Shutter:
         self.sendCommand(shutterId, self.buttonProg, 1)
 
     def registerCallBack(self, callbackFunction):
-        self.callback.append(callbackFunction)
+        with self.sutterStateLock:
+            self.callback.append(callbackFunction)
+
+    # Reuse the connection to pigpiod, only reconnect when there is none or it failed to connect. A connection
+    # that died later is dropped by transmit.
+    def connect(self):
+        if self.pi == None or not self.pi.connected:
+            self.pi = pigpio.pi() # connect to Pi
+            if self.pi.connected:
+                self.pi.set_mode(self.TXGPIO, pigpio.OUTPUT)
+        return self.pi
+
+    def close(self):
+        if self.pi != None:
+            if self.pi.connected:
+                try:
+                    self.pi.stop()
+                except OSError: # the socket may already be dead
+                    pass
+            self.pi = None
+
+    def __del__(self):
+        self.close()
+
+    def _frameHex(self):
+        return " ".join("0x%0.2X" % octet for octet in self.frame)
+
+    # Manchester encoding of the (obfuscated) frame, one table lookup per byte.
+    def _encodeFrame(self):
+        bytePulses = self.bytePulses
+        out = []
+        for octet in self.frame:
+            out += bytePulses[octet]
+        return out
 
     def sendCommand(self, shutterId, button, repetition): #Sending a frame
     # Sending more than two repetitions after the original frame means a button kept pressed and moves the blind in steps 
@@ -225,29 +394,18 @@ class Shutter:
     # frame and more repetitions moves the blinds up/down for a longer time.
     # To activate the program mode (to register or de-register additional remotes) of your Somfy blinds, long press the 
     # prog button (at least thirteen times after the original frame to activate the registration.
-        print("sendCommand: Waiting for Lock")
-        self.lock.acquire()
-        try:
-            print("sendCommand: Lock aquired")
+        log.debug("sendCommand: Waiting for Lock")
+        with self.lock:
+            log.debug("sendCommand: Lock aquired")
             checksum = 0
-            teleco = int(shutterId, 16)
-            code = int(self.config.Shutters[shutterId]['code'])
+            teleco = self.config.Shutters[shutterId]['teleco']
+            code = self.config.nextCode(shutterId)
 
             # print (codecs.encode(shutterId, 'hex_codec'))
-            self.config.setCode(shutterId, code+1)
-
-            pi = pigpio.pi() # connect to Pi
-
-            if not pi.connected:
-                exit()
-
-            pi.wave_add_new()
-            pi.set_mode(self.TXGPIO, pigpio.OUTPUT)
 
-            print("Remote  :      " + "0x%0.2X" % teleco + ' (' + self.config.Shutters[shutterId]['name'] + ')')
-            print("Button  :      " + "0x%0.2X" % button)
-            print("Rolling code : " + str(code))
-            print("")
+            log.debug("Remote  :      0x%0.2X (%s)", teleco, self.config.Shutters[shutterId]['name'])
+            log.debug("Button  :      0x%0.2X", button)
+            log.debug("Rolling code : %s", code)
 
             self.frame[0] = 0xA7;       # Encryption key. Doesn't matter much
             self.frame[1] = button << 4 # Which button did  you press? The 4 LSB will be the checksum
@@ -257,127 +415,155 @@ class Shutter:
             self.frame[5] = ((teleco >>  8) & 0xFF) # Remote address
             self.frame[6] = (teleco & 0xFF)         # Remote address
 
-            outstring = "Frame  :    "
-            for octet in self.frame:
-                outstring = outstring + "0x%0.2X" % octet + ' '
-                print(outstring)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Frame  :    " + self._frameHex())
 
-            for i in range(0, 7):
-                checksum = checksum ^ self.frame[i] ^ (self.frame[i] >> 4)
+            for octet in self.frame:
+                checksum ^= octet ^ (octet >> 4)
 
             checksum &= 0b1111; # We keep the last 4 bits only
 
             self.frame[1] |= checksum;
 
-            outstring = "With cks  : "
-            for octet in self.frame:
-                outstring = outstring + "0x%0.2X" % octet + ' '
-            print(outstring)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("With cks  : " + self._frameHex())
 
+            frame = self.frame
+            previous = frame[0]
             for i in range(1, 7):
-                self.frame[i] ^= self.frame[i-1];
+                previous ^= frame[i]
+                frame[i] = previous
 
-            outstring = "Obfuscated :"
-            for octet in self.frame:
-                outstring = outstring + "0x%0.2X" % octet + ' '
-            print(outstring)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Obfuscated :" + self._frameHex())
 
             #This is where all the awesomeness is happening. You're telling the daemon what you wanna send
-            wf=[]
-            wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 9415)) # wake up pulse
-            wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 89565)) # silence
-            for i in range(2): # hardware synchronization
-                wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 2560))
-                wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 2560))
-            wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 4550)) # software synchronization
-            wf.append(pigpio.pulse(0, 1<<self.TXGPIO,  640))
-
-            for i in range (0, 56): # manchester enconding of payload data
-                if ((self.frame[int(i/8)] >> (7 - (i%8))) & 1):
-                    wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 640))
-                    wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 640))
-                else:
-                    wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 640))
-                    wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 640))
-
-            wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 30415)) # interframe gap
-
-            for j in range(1,repetition): # repeating frames
-                for i in range(7): # hardware synchronization
-                    wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 2560))
-                    wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 2560))
-                wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 4550)) # software synchronization
-                wf.append(pigpio.pulse(0, 1<<self.TXGPIO,  640))
-
-                for i in range (0, 56): # manchester enconding of payload data
-                    if ((self.frame[int(i/8)] >> (7 - (i%8))) & 1):
-                        wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 640))
-                        wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 640))
-                    else:
-                        wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 640))
-                        wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 640))
-
-                wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 30415)) # interframe gap
-
-            pi.wave_add_generic(wf)
-            wid = pi.wave_create()
-            pi.wave_send_once(wid)
-            while pi.wave_tx_busy():
-                pass
-            pi.wave_delete(wid)
-
-            pi.stop()
+            encoded = self._encodeFrame() # manchester enconding of payload data, shared by all repetitions
+
+            first = list(self.wakeUp)
+            first += self.hwSync * 2
+            first += self.swSync
+            first += encoded
+            first.append(self.gap)
+
+            repeat = self.hwSync * 7 # repeating frame, looped by pigpiod
+            repeat += self.swSync
+            repeat += encoded
+            repeat.append(self.gap)
+
+            # Take the transmitter before letting the next command in, so rolling codes go on air in order
+            self.txLock.acquire()
+        log.debug("sendCommand: Lock released")
+
+        try:
+            self.transmit(first, repeat, repetition - 1)
         finally:
-            self.lock.release()
-            print("sendCommand: Lock released")
+            self.txLock.release()
+
+    # pigpiod plays one wave at a time and a new send aborts the one on air, so the transmission is
+    # serialized on txLock (held by the caller). The next command can build its frame meanwhile.
+    # The repetitions are a wave_chain loop over a single repeating frame instead of being inlined.
+    def transmit(self, first, repeat, repeatCount):
+        try:
+            self.transmitOnce(first, repeat, repeatCount)
+        except (OSError, struct.error, pigpio.error) as e:
+            # pigpio keeps connected == True when the daemon restarts under it, so a dead socket only shows up
+            # here. Drop the connection and retry once on a fresh one.
+            log.warning("pigpiod transmission failed (%s), reconnecting and retrying once", e)
+            self.close()
+            self.transmitOnce(first, repeat, repeatCount)
+
+    def transmitOnce(self, first, repeat, repeatCount):
+        pi = self.connect()
+
+        if not pi.connected:
+            # Raise instead of exit(): this runs on a shutter worker thread, which has to log the failure and go on
+            log.error("pigpio connection could not be established. Check logs to get more details.")
+            raise ConnectionError("pigpiod is not reachable")
+
+        pi.wave_add_new()
+        pi.wave_add_generic(first)
+        firstWid = pi.wave_create()
+        duration = pi.wave_get_micros()
+        chain = [firstWid]
+        repeatWid = None
+        if repeatCount > 0:
+            pi.wave_add_generic(repeat)
+            repeatWid = pi.wave_create()
+            duration += repeatCount * pi.wave_get_micros()
+            chain += [255, 0, repeatWid, 255, 1, repeatCount & 0xFF, (repeatCount >> 8) & 0xFF]
+        duration = duration / 1000000.0
+
+        with realtime(): # only the submission, pigpiod plays the chain by DMA
+            pi.wave_chain(chain)
+        time.sleep(max(0, duration - 0.002)) # sleep for the known length of the chain, then poll for the tail
+        while pi.wave_tx_busy():
+            time.sleep(0.001)
+
+        pi.wave_delete(firstWid)
+        if repeatWid != None:
+            pi.wave_delete(repeatWid)
 
 class OperateShutter:
 
     def __init__(self, shutter: Shutter) -> None:
         self.__shutter = shutter
+        self.__queues = {} # command queue per shutter, each drained by its own worker thread
+        self.__queuesLock = threading.Lock()
 
-    def startPIGPIO(self):
-        if sys.version_info[0] < 3:
-            import commands
-            status, process = commands.getstatusoutput('sudo pidof pigpiod')
-            if status:  #  it wasn't running, so start it
-                print("pigpiod was not running")
-                commands.getstatusoutput('sudo pigpiod -l -m')  # try to  start it
-                time.sleep(0.5)
-                # check it again
-                status, process = commands.getstatusoutput('sudo pidof pigpiod')
-        else:
-            import subprocess
-            status, process = subprocess.getstatusoutput('sudo pidof pigpiod')
-            if status:  #  it wasn't running, so start it
-                print("pigpiod was not running")
-                subprocess.getstatusoutput('sudo pigpiod -l -m')  # try to  start it
-                time.sleep(0.5)
-                # check it again
-                status, process = subprocess.getstatusoutput('sudo pidof pigpiod')
-
-        if not status:  # if it was started successfully (or was already running)...
-            pigpiod_process = process
-            print("pigpiod is running, process ID is {} ".format(pigpiod_process))
+    # Probe the daemon by connecting to it, only fall back to starting pigpiod when that fails.
+    # The probe connection is the shutter's own one, so it is reused for the first command.
+    def probePIGPIO(self):
+        try:
+            return self.__shutter.connect().connected
+        except Exception as e:
+            log.error("problem instantiating pi: %s", e)
+            return False
 
-            try:
-                pi = pigpio.pi()  # local GPIO only
-                if not pi.connected:
-                    print("pigpio connection could not be established. Check logs to get more details.")
-                    return False
-                else:
-                    print("pigpio's pi instantiated.")
-            except Exception as e:
-                start_pigpiod_exception = str(e)
-                print("problem instantiating pi: {}".format(start_pigpiod_exception))
-        else:
-            print("start pigpiod was unsuccessful.")
+    def startPIGPIO(self):
+        if self.probePIGPIO():
+            log.debug("pigpio's pi instantiated.")
+            return True
+
+        log.warning("pigpiod was not running")
+        import subprocess
+        subprocess.run(['sudo', 'pigpiod', '-l', '-m'], check = False)  # try to  start it
+        time.sleep(0.5)
+
+        # check it again
+        if not self.probePIGPIO():
+            log.error("start pigpiod was unsuccessful. Check logs to get more details.")
             return False
+        log.info("pigpiod started")
         return True
 
+    # Queue the message for its shutter and return right away. Commands for one shutter run in order on that
+    # shutter's worker, different shutters run side by side and only serialize on the transmitter.
     def process(self, message: dict) -> None:
-        print(f"OperateShutter - incoming message {message}")
+        log.info("OperateShutter - incoming message %s", message)
+
+        shutterId = message.get("name")
+        if shutterId not in self.__shutter.config.Shutters:
+            log.warning("OperateShutter - unknown shutter %s", shutterId)
+            return
+
+        with self.__queuesLock:
+            commands = self.__queues.get(shutterId)
+            if commands == None:
+                commands = queue.Queue()
+                self.__queues[shutterId] = commands
+                threading.Thread(target = self.__worker, args = (commands,), name = "shutter-" + str(shutterId), daemon = True).start()
+        commands.put(message)
+
+    def __worker(self, commands: queue.Queue) -> None:
+        while True:
+            message = commands.get()
+            try:
+                self.execute(message)
+            except Exception:
+                log.exception("OperateShutter - failed to execute %s", message)
 
+    def execute(self, message: dict) -> None:
         if message.get("command") == "program":
             self.__shutter.program(message.get("name"))
 
@@ -422,7 +608,7 @@ class MqttReceiver:
 
     def on_message(self, client, userdata, message):
         payload = message.payload.decode("utf-8")
-        print("Received message:", payload)
+        log.debug("Received message: %s", payload)
 
         # Parse the JSON payload
         data = json.loads(payload)
@@ -451,6 +637,12 @@ pi@laurensiot:~ $ mosquitto_pub -h localhost -t shutter_control -m '{"msg_type":
 '''
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Somfy shutter control over MQTT")
+    parser.add_argument("-l", "--loglevel", default = "WARNING", choices = ["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help = "log level, DEBUG also dumps every frame sent")
+    args = parser.parse_args()
+    logging.basicConfig(level = args.loglevel, format = "%(asctime)s %(levelname)s %(threadName)s: %(message)s")
+
     version = "0.0.1"
     topics = ["shutter_control"]
     broker_address = "127.0.0.1"
@@ -458,7 +650,7 @@ if __name__ == "__main__":
 
     console = ConsoleOutput()
 
-    config = Config()
+    config = Config(os.path.join(os.path.dirname(os.path.abspath(__file__)), "codes.json"))
     shutter = Shutter(config)
     operate_shutter = OperateShutter(shutter)
     if not operate_shutter.startPIGPIO():
@@ -484,4 +676,6 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         print("\nKeyboard interrupt detected. Stopping MQTT receiver...")
         mqtt_listener.stop()
+        shutter.close()
+        config.flush()
     
\ No newline at end of file